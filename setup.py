@@ -13,6 +13,9 @@ setup(
         'gymnasium==1.0.0',
         'pybullet'
     ],
+    extras_require={
+        'numba': ['numba'],  # JIT-compiled quaternion helpers in urgym.base.utilities
+    },
     author='Inaki Vazquez',
     author_email='ivazquez@deusto.es',
     description='A set of Pybullet-based Gymnasium compatible environments for Universal Robots UR5',
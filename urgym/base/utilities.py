@@ -1,13 +1,20 @@
 import pybullet as p
 import glob
-from collections import namedtuple
-import functools
-import torch
-import cv2
-from scipy import ndimage
+import re
 import numpy as np
 import math
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, run the kernels as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# Component types that mean a quaternion argument was a batch rather than a single quaternion
+_QUATERNION_BATCH_TYPES = (list, tuple, np.ndarray)
+
 
 class Models:
     def load_objects(self):
@@ -24,6 +31,8 @@ class YCBModels(Models):
     def __init__(self, root, selected_names: tuple = ()):
         self.obj_files = glob.glob(root)
         self.selected_names = selected_names
+        # A single pattern matching any of the selected names, checked once per file
+        self._selected_pattern = re.compile('|'.join(map(re.escape, selected_names))) if selected_names else None
 
         self.visual_shapes = []
         self.collision_shapes = []
@@ -34,13 +43,8 @@ class YCBModels(Models):
 
         for filename in self.obj_files:
             # Check selected_names
-            if self.selected_names:
-                in_selected = False
-                for name in self.selected_names:
-                    if name in filename:
-                        in_selected = True
-                if not in_selected:
-                    continue
+            if self._selected_pattern is not None and not self._selected_pattern.search(filename):
+                continue
             print('Loading %s' % filename)
             self.collision_shapes.append(
                 p.createCollisionShape(shapeType=p.GEOM_MESH,
@@ -60,8 +64,12 @@ class YCBModels(Models):
         return self.visual_shapes[idx], self.collision_shapes[idx]
 
 
+# Connection methods backed by a GUI physics server, which has an OpenGL context for rendering
+_GUI_CONNECTION_METHODS = (p.GUI, p.GUI_SERVER, p.GUI_MAIN_THREAD, p.SHARED_MEMORY, p.SHARED_MEMORY_GUI)
+
+
 class Camera:
-    def __init__(self, cam_pos, cam_tar, cam_up_vector, near, far, size, fov):
+    def __init__(self, cam_pos, cam_tar, cam_up_vector, near, far, size, fov, device=None):
         self.width, self.height = size
         self.near, self.far = near, far
         self.fov = fov
@@ -70,9 +78,38 @@ class Camera:
         self.view_matrix = p.computeViewMatrix(cam_pos, cam_tar, cam_up_vector)
         self.projection_matrix = p.computeProjectionMatrixFOV(self.fov, aspect, self.near, self.far)
 
-        _view_matrix = np.array(self.view_matrix).reshape((4, 4), order='F')
-        _projection_matrix = np.array(self.projection_matrix).reshape((4, 4), order='F')
+        # pybullet returns the matrices in column-major order; a C-order reshape
+        # followed by a transpose is a view, whereas order='F' forces a copy
+        _view_matrix = np.asarray(self.view_matrix, dtype=np.float64).reshape(4, 4).T
+        _projection_matrix = np.asarray(self.projection_matrix, dtype=np.float64).reshape(4, 4).T
         self.tran_pix_world = np.linalg.inv(_projection_matrix @ _view_matrix)
+        self._tran_pix_world_T_f32 = self.tran_pix_world.T.astype(np.float32)
+
+        # The pixel grid only depends on the image size, so the x, y and ones columns
+        # are filled once and rgbd_2_world_batch only rewrites the depth column
+        xs = (2 * np.arange(self.width, dtype=np.float32) - self.width) / self.width
+        ys = -(2 * np.arange(self.height, dtype=np.float32) - self.height) / self.height
+        x = np.broadcast_to(xs[None, :], (self.height, self.width))
+        y = np.broadcast_to(ys[:, None], (self.height, self.width))
+        self._pix_pos = np.empty((self.height * self.width, 4), dtype=np.float32)
+        # Reshaping a strided column is a view, so the broadcast grids are copied straight into it
+        np.copyto(self._pix_pos[:, 0].reshape(self.height, self.width), x)
+        np.copyto(self._pix_pos[:, 1].reshape(self.height, self.width), y)
+        self._pix_pos[:, 3] = 1
+        self._world_buf = np.empty_like(self._pix_pos)
+        self._out_shape = (self.height, self.width, 3)
+        # Picked on the first shot, since the camera may be created before connecting
+        self._renderer = None
+
+        # Only when a torch device is requested (e.g. device='cuda') does rgbd_2_world_batch
+        # keep the grid and the matrix on that device; by default it stays in NumPy.
+        # torch is optional and heavy to import, so it is only loaded in that case
+        self._device = device
+        if self._device is not None:
+            import torch
+
+            self._M_t = torch.tensor(self._tran_pix_world_T_f32, device=self._device)
+            self._pix_t = torch.tensor(self._pix_pos, device=self._device)
 
     def rgbd_2_world(self, w, h, d):
         x = (2 * w - self.width) / self.width
@@ -84,29 +121,54 @@ class Camera:
 
         return position[:3]
 
-    def shot(self):
-        # Get depth values using the OpenGL renderer
+    def shot(self, segmentation=True):
+        # Get depth values using the OpenGL renderer when a GUI context exists,
+        # DIRECT connections have no OpenGL and need the software renderer
+        if self._renderer is None:
+            if p.getConnectionInfo()['connectionMethod'] in _GUI_CONNECTION_METHODS:
+                self._renderer = p.ER_BULLET_HARDWARE_OPENGL
+            else:
+                self._renderer = p.ER_TINY_RENDERER
+        flags = 0 if segmentation else p.ER_NO_SEGMENTATION_MASK
         _w, _h, rgb, depth, seg = p.getCameraImage(self.width, self.height,
                                                    self.view_matrix, self.projection_matrix,
-                                                   )
+                                                   shadow=0, flags=flags, renderer=self._renderer)
+
+        # Already arrays when pybullet is built with NumPy, so these are views, not copies
+        rgb = np.reshape(np.asarray(rgb, dtype=np.uint8), (self.height, self.width, 4))
+        depth = np.reshape(np.asarray(depth, dtype=np.float32), (self.height, self.width))
+        if not segmentation:
+            return rgb, depth, None
+        seg = np.reshape(np.asarray(seg, dtype=np.int32), (self.height, self.width))
         return rgb, depth, seg
 
     def rgbd_2_world_batch(self, depth):
         # reference: https://stackoverflow.com/a/62247245
-        x = (2 * np.arange(0, self.width) - self.width) / self.width
-        x = np.repeat(x[None, :], self.height, axis=0)
-        y = -(2 * np.arange(0, self.height) - self.height) / self.height
-        y = np.repeat(y[:, None], self.width, axis=1)
-        z = 2 * depth - 1
+        if self._device is not None:
+            return self._rgbd_2_world_batch_torch(depth)
+
+        # One pixel per row, so the product below is C-contiguous without a transpose
+        # np.ravel is a view for contiguous depth buffers, so z is written straight into its column
+        z = self._pix_pos[:, 2]
+        np.multiply(np.ravel(depth), 2, out=z, casting='unsafe')
+        z -= 1
+        np.matmul(self._pix_pos, self._tran_pix_world_T_f32, out=self._world_buf)
 
-        pix_pos = np.array([x.flatten(), y.flatten(), z.flatten(), np.ones_like(z.flatten())]).T
-        position = self.tran_pix_world @ pix_pos.T
-        position = position.T
-        # print(position)
+        # Dividing into a new array keeps the returned points independent of the buffer
+        position = self._world_buf[:, :3] / self._world_buf[:, 3:4]
 
-        position[:, :] /= position[:, 3:4]
+        return position.reshape(self._out_shape)
 
-        return position[:, :3].reshape(*x.shape, -1)
+    def _rgbd_2_world_batch_torch(self, depth):
+        import torch
+
+        d_t = torch.from_numpy(np.ascontiguousarray(depth, dtype=np.float32))
+        d_t = d_t.to(self._device, non_blocking=True)
+        self._pix_t[:, 2] = (2 * d_t - 1).view(-1)
+        position = self._pix_t @ self._M_t
+        position = position[:, :3] / position[:, 3:4]
+
+        return position.reshape(self._out_shape).cpu().numpy()
 
 def print_links(body_id):
     """
@@ -135,23 +197,58 @@ def rotate_quaternion(quaternion, angle, axis):
     """
     Rotates a quaternion by a given angle around a given axis.
 
+    A batch of quaternions of shape (..., 4) (NumPy array or nested lists/tuples)
+    may be given instead of a single one; all of them are rotated in one call.
+
     Parameters:
-    - quaternion: The quaternion to rotate
+    - quaternion: The quaternion to rotate, or a batch of quaternions
     - angle: The angle to rotate
     - axis: The axis to rotate around
 
     Returns:
-    The rotated quaternion
+    The rotated quaternion as a tuple, or an array of shape (..., 4) for a batch
     """
+    try:
+        x, y, z, w = quaternion
+    except ValueError:
+        # A batch of other than 4 quaternions cannot be unpacked as one
+        single = False
+    else:
+        # Same check as quaternion_multiply: a batch of exactly 4 unpacks into rows
+        single = type(w) is float or not isinstance(w, _QUATERNION_BATCH_TYPES)
+
+    if single:
+        return _rotate_quat_scalar(x, y, z, w, angle, axis[0], axis[1], axis[2])
+
     # Create a quaternion from the axis and angle
-    rot_quaternion = p.getQuaternionFromAxisAngle(axis, angle)
-    # Multiply the original quaternion by the rotation quaternion
-    return quaternion_multiply(quaternion, rot_quaternion)
+    rot_quaternion = _quat_from_axis_angle_scalar(axis[0], axis[1], axis[2], angle)
+    # Multiply the original quaternions by the rotation quaternion
+    return quaternion_multiply(np.asarray(quaternion, dtype=float), np.array(rot_quaternion))
+
+@njit(cache=True, fastmath=True, inline='always')
+def _quat_from_axis_angle_scalar(ax, ay, az, angle):
+    # Same convention as p.getQuaternionFromAxisAngle: the axis is normalized
+    # and a degenerate axis falls back to the x axis
+    length = math.sqrt(ax * ax + ay * ay + az * az)
+    if length < 1.1920929e-07:
+        ax, ay, az, length = 1.0, 0.0, 0.0, 1.0
+    s = math.sin(angle * 0.5) / length
+    return ax * s, ay * s, az * s, math.cos(angle * 0.5)
+
+@njit(cache=True, fastmath=True)
+def _rotate_quat_scalar(x, y, z, w, angle, ax, ay, az):
+    rx, ry, rz, rw = _quat_from_axis_angle_scalar(ax, ay, az, angle)
+    return _quat_mul_scalar(x, y, z, w, rx, ry, rz, rw)
 
 def quaternion_multiply(quat1, quat2):
     """
     Multiplies two quaternions.
 
+    Quaternions are given in (x, y, z, w) order. Either a single quaternion or
+    a batch of shape (..., 4) (NumPy array or nested lists/tuples) is accepted
+    for each argument; if either is a batch, both are broadcast against each
+    other and multiplied in one call using the matrix form of the Hamilton product.
+
     Parameters:
     - quat1: The first quaternion
     - quat2: The second quaternion
@@ -160,10 +257,45 @@ def quaternion_multiply(quat1, quat2):
     The result of the multiplication
     """
 
-    # Get the real and imaginary parts of the quaternions
-    x1, y1, z1, w1 = quat1
-    x2, y2, z2, w2 = quat2
-
+    try:
+        # Get the real and imaginary parts of the quaternions
+        x1, y1, z1, w1 = quat1
+        x2, y2, z2, w2 = quat2
+    except ValueError:
+        # A batch of other than 4 quaternions cannot be unpacked as one
+        single = False
+    else:
+        # A batch of exactly 4 quaternions unpacks into rows instead of components;
+        # plain floats, the common case, are accepted without the isinstance checks
+        single = (type(w1) is float and type(w2) is float
+                  or not (isinstance(w1, _QUATERNION_BATCH_TYPES) or isinstance(w2, _QUATERNION_BATCH_TYPES)))
+
+    if single:
+        # Unrolled in plain Python: for 16 flops the numba dispatch costs more than it saves
+        # Calculate the real part of the result
+        w = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
+        # Calculate the imaginary parts of the result
+        x = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
+        y = w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2
+        z = w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
+
+        return x, y, z, w
+
+    x1, y1, z1, w1 = np.moveaxis(np.asarray(quat1), -1, 0)
+
+    # Left-multiplication matrix of quat1, acting on quat2 in (x, y, z, w) order
+    M = np.stack([
+        np.stack([w1, -z1, y1, x1], axis=-1),
+        np.stack([z1, w1, -x1, y1], axis=-1),
+        np.stack([-y1, x1, w1, z1], axis=-1),
+        np.stack([-x1, -y1, -z1, w1], axis=-1),
+    ], axis=-2)
+
+    return np.einsum('...ij,...j->...i', M, np.asarray(quat2))
+
+# Only used from inside other kernels, where inlining lets numba fuse it with the caller
+@njit(cache=True, fastmath=True, inline='always')
+def _quat_mul_scalar(x1, y1, z1, w1, x2, y2, z2, w2):
     # Calculate the real part of the result
     w = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
     # Calculate the imaginary parts of the result
@@ -172,22 +304,66 @@ def quaternion_multiply(quat1, quat2):
     z = w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
 
     return x, y, z, w
+
+def quaternion_multiply_batch(Q1, Q2):
+    """
+    Multiplies two arrays of quaternions element-wise.
+
+    Parameters:
+    - Q1: Array of shape (N, 4) with the first quaternions in (x, y, z, w) order
+    - Q2: Array of shape (N, 4) with the second quaternions in (x, y, z, w) order
+
+    Returns:
+    Array of shape (N, 4) with the products
+    """
+    Q1 = np.asarray(Q1)
+    Q2 = np.asarray(Q2)
+    xyz1, w1 = Q1[..., :3], Q1[..., 3]
+    xyz2, w2 = Q2[..., :3], Q2[..., 3]
+
+    w = w1 * w2 - (xyz1 * xyz2).sum(-1)
+    xyz = w1[..., None] * xyz2 + w2[..., None] * xyz1 + np.cross(xyz1, xyz2)
+
+    return np.concatenate([xyz, w[..., None]], axis=-1)
     
-def normalize_quaternion(qx, qy, qz, qw):
+def normalize_quaternion(*args):
+    """
+    Normalizes a quaternion, or an array of quaternions, to unit length.
+
+    Quaternions with zero norm cannot be normalized and are replaced by the
+    identity quaternion (0, 0, 0, 1).
+
+    Parameters:
+    - args: Either the four components qx, qy, qz, qw, a single quaternion, or
+      an array of shape (..., 4) with one quaternion per row
+
+    Returns:
+    The normalized quaternion as a tuple, or an array with the shape of the input
+    """
+    if len(args) == 1:
+        q = np.asarray(args[0], dtype=float)
+        if q.ndim < 2:
+            return _normalize_quat_scalar(*q)
+
+        n2 = np.einsum('...i,...i->...', q, q)
+        inv_norm = np.divide(1.0, np.sqrt(n2), out=np.zeros_like(n2), where=n2 > 0)
+        return q * inv_norm[..., None] + np.array([0.0, 0.0, 0.0, 1.0]) * (n2 == 0)[..., None]
+
+    qx, qy, qz, qw = args
+    return _normalize_quat_scalar(qx, qy, qz, qw)
+
+@njit(cache=True, fastmath=True)
+def _normalize_quat_scalar(qx, qy, qz, qw):
     # Calculate the norm of the quaternion
-    norm = np.sqrt(qx**2 + qy**2 + qz**2 + qw**2)
+    norm = math.sqrt(qx * qx + qy * qy + qz * qz + qw * qw)
     
     # If the norm is 0, we cannot normalize the quaternion, return a default valid quaternion
     if norm == 0:
         return 0.0, 0.0, 0.0, 1.0
     
-    # Normalize the quaternion
-    qx /= norm
-    qy /= norm
-    qz /= norm
-    qw /= norm
-    
-    return qx, qy, qz, qw
+    # Normalize the quaternion, multiplying by the reciprocal of the norm
+    inv_norm = 1.0 / norm
+    return qx * inv_norm, qy * inv_norm, qz * inv_norm, qw * inv_norm
 
 def geometric_distance_reward(value: float, threshold_sign: float, threshold_max: float) -> float:
     """Returns a geometric reward which is positive from 0 to +1 in the range [0, threshold_sign] and negative for values larger than
@@ -201,10 +377,27 @@ def geometric_distance_reward(value: float, threshold_sign: float, threshold_max
     Returns:
         float: a normalized reward between -1 and +1
     """
-    value = max (value, 1e-10) # To avoid division by zero
-    factor1 = (value - threshold_sign) / value
+    value = max(value, 1e-10) # To avoid division by zero
+    factor1 = 1.0 - threshold_sign / value
     factor2 = max(threshold_max - value, 1e-10)  # To avoid division by zero
-    return -np.tanh(factor1/factor2)
+    return -math.tanh(factor1 / factor2)
+
+def geometric_distance_reward_batch(values, threshold_sign, threshold_max):
+    """Returns the geometric_distance_reward of every distance in values, e.g. one per sub-environment
+    of a vectorized env, in a single call
+
+    Args:
+        values (type): array of shape (N,) with distance values between 0 and infinity
+        threshold_sign (type): threshold that divides positive and negative rewards, scalar or (N,)
+        threshold_max (type): maximum value of distance to generate a -1 reward, scalar or (N,)
+
+    Returns:
+        np.ndarray: array of shape (N,) with normalized rewards between -1 and +1
+    """
+    values = np.maximum(np.asarray(values, dtype=np.float64), 1e-10) # To avoid division by zero
+    factor1 = 1.0 - np.asarray(threshold_sign) / values
+    factor2 = np.maximum(threshold_max - values, 1e-10)  # To avoid division by zero
+    return -np.tanh(factor1 / factor2)
 
 def print_link_names_and_indices(id):
     """
@@ -221,66 +414,52 @@ def print_link_names_and_indices(id):
         print(f"Link Index: {i}, Link Name: {link_name}")
 
 
-def is_pointing_downwards(qx, qy, qz, qw, threshold=1e-1):    
-    return z_alignment_distance(qx, qy, qz, qw) <= threshold
+def is_pointing_downwards(qx, qy, qz, qw, threshold=1e-1):
+    """
+    Checks whether the local z axis of an orientation points downwards.
 
+    Equivalent to z_alignment_distance(qx, qy, qz, qw) <= threshold, but
+    compares the z component of the rotated axis against -cos(pi * threshold)
+    instead of taking the arccos, since arccos is monotonic.
 
-def _z_alignment_distance(qx, qy, qz, qw):
-    # If aligned in z direction downwards:
-    # qx = -qz and qy = qw
+    Parameters:
+    - qx, qy, qz, qw: The orientation quaternion
+    - threshold: Maximum normalized angle, in [0, 1], to the downward direction
 
-    # These differences should be close to zero if the object is vertically downwards
-    diff1 = abs(qx + qz) 
-    diff2 = abs(qy - qw) 
+    Returns:
+    True if the orientation is within the threshold of pointing downwards
+    """
+    return 1 - 2 * (qx * qx + qy * qy) <= -np.cos(np.pi * threshold)
 
-    scaled_difference = (diff1 + diff2) / 4 # Always in the range from 0 to 1
 
-    #print(f"qx: {qx}, qy: {qy}, qz: {qz}, qw: {qw}")
-    
-    # Return the scaled difference
-    return scaled_difference
+def z_alignment_distance(qx, qy, qz, qw):
+    """
+    Returns the normalized angle between the local z axis of an orientation and
+    the world downward direction [0, 0, -1].
 
-def z_alignment_distance(roll, pitch, yaw):
-    
-    # The ideal downward direction vector
-    downward = np.array([0, 0, -1])
-    
-    # Calculate the rotation matrix from Euler angles
-    Rx = np.array([
-        [1, 0, 0],
-        [0, np.cos(roll), -np.sin(roll)],
-        [0, np.sin(roll), np.cos(roll)]
-    ])
-    
-    Ry = np.array([
-        [np.cos(pitch), 0, np.sin(pitch)],
-        [0, 1, 0],
-        [-np.sin(pitch), 0, np.cos(pitch)]
-    ])
-    
-    Rz = np.array([
-        [np.cos(yaw), -np.sin(yaw), 0],
-        [np.sin(yaw), np.cos(yaw), 0],
-        [0, 0, 1]
-    ])
-    
-    # Combined rotation matrix
-    R = Rz @ Ry @ Rx
-    
-    # Rotate the downward direction vector
-    rotated_downward = R @ downward
-    
-    # Compute the cosine of the angle between the vectors
-    dot_product = np.dot(rotated_downward, downward)
-    magnitude_rotated_downward = np.linalg.norm(rotated_downward)
-    magnitude_downward = np.linalg.norm(downward)
-    
-    cos_theta = dot_product / (magnitude_rotated_downward * magnitude_downward)
-    
-    # Compute the angle in radians
-    theta = np.arccos(np.clip(cos_theta, -1.0, 1.0))
-    
-    # Normalize the angle to the range [0, 1]
-    normalized_theta = theta / np.pi
-    
-    return normalized_theta
\ No newline at end of file
+    Only the z component of the rotated z axis, 1 - 2 * (qx^2 + qy^2), is
+    needed, so no rotation matrix is built. Arrays of components are accepted
+    and evaluated element-wise.
+
+    Parameters:
+    - qx, qy, qz, qw: The orientation quaternion
+
+    Returns:
+    The angle normalized to the range [0, 1], 0 when the z axis points downwards
+    """
+    rz2 = 1 - 2 * (qx * qx + qy * qy)
+    return np.arccos(np.clip(-rz2, -1.0, 1.0)) / np.pi
+
+def z_alignment_distance_batch(quats):
+    """
+    Returns the z_alignment_distance of every quaternion in quats, e.g. one per
+    sub-environment of a vectorized env, in a single call.
+
+    Parameters:
+    - quats: Array of shape (N, 4) with quaternions in (x, y, z, w) order
+
+    Returns:
+    Array of shape (N,) with the angles normalized to the range [0, 1]
+    """
+    quats = np.asarray(quats, dtype=np.float64)
+    return z_alignment_distance(quats[..., 0], quats[..., 1], quats[..., 2], quats[..., 3])